@@ -47,6 +47,7 @@ wrapper.add_fake_argument('include_animations', bool)
 wrapper.add_fake_argument('bones_per_vert_mod', int)
 wrapper.add_fake_argument('bones_per_vert_max', int)
 wrapper.add_fake_argument('bones_per_mesh_max', int)
+wrapper.add_fake_argument('pack_bone_weights', bool)
 wrapper.add_fake_argument('approx_animations', bool)
 wrapper.add_fake_argument('debug_animations', bool)
 wrapper.add_fake_argument('approx_err_translations', float)
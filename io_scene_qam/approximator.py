@@ -1,10 +1,11 @@
-from numpy import array
-import math
+from numpy import asarray, float64
 
 try:
     import utils
+    from kernels import maxLineError
 except:
     from . import utils
+    from .kernels import maxLineError
 
 __all__ = (
     'Approximator'
@@ -14,7 +15,6 @@ class Approximator:
 
     def __init__(self, size):
         self._size = size
-        self._tmpVec = array([0.0 for i in range(0, size)])
 
     def approximate(self, points, err):
         indices = [0, len(points) - 1]
@@ -55,12 +55,7 @@ class Approximator:
         index = -1
         if init > end:
             return index, 0
-        maxValue = 0
-        for i in range(init + 1, end):
-            sqDis  = self.onLine(points[init], points[end], points[i])
-            if sqDis > maxValue:
-                maxValue = sqDis
-                index = i
+        index, maxValue = maxLineError(asarray(points, dtype=float64), init, end)
         if maxValue > err:
             return index, maxValue
         else:
@@ -74,30 +69,3 @@ class Approximator:
                 maxIndex = idx
                 max = val[1]
         return maxIndex
-
-    def onLine(self, p1, p2, pa):
-        pd = self._tmpVec
-        dsq = self.distanceSq(p1, p2, pd)
-        if dsq == 0:
-            return 0.0
-        else:
-            u = 0.0
-            for i in range(0, len(p1)):
-                u += (pa[i] - p1[i]) * pd[i]
-            u /= dsq
-            if u <= 0:
-                return self.distanceSq(p1, pa, pd)
-            elif u >= 1:
-                return self.distanceSq(p2, pa, pd)
-            else:
-                for i in range(0, len(p1)):
-                    pd[i] = p1[i] + u * pd[i]
-                return self.distanceSq(pd, pa, pd)
-
-    def distanceSq(self, p1, p2, pd):
-        for i in range(0, len(p1)):
-            pd[i] = p2[i] - p1[i]
-        sum = 0.0
-        for i in range(0, len(p1)):
-            sum += pd[i]*pd[i]
-        return sum
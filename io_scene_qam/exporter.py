@@ -1,8 +1,9 @@
 import os
 import bpy
+from collections import defaultdict
 import mathutils
 
-from numpy import array
+import numpy as np
 
 from bpy.props import (
         BoolProperty,
@@ -132,6 +133,12 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
             soft_min=8, soft_max=100
             )
 
+    pack_bone_weights: BoolProperty(
+            name="Pack bone weights",
+            description="Store bone weights as normalized bytes, four per float",
+            default=False
+            )
+
     approx_animations: BoolProperty(
             name="Approx animations",
             description="Approximate animations",
@@ -198,6 +205,7 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
             layout.prop(self, "bones_per_vert_mod")
             layout.prop(self, "bones_per_vert_max")
             layout.prop(self, "bones_per_mesh_max")
+            layout.prop(self, "pack_bone_weights")
         elif self.ui_tab == 'ANIMATION':
             layout.prop(self, "include_animations")
             layout.prop(self, "approx_animations")
@@ -277,6 +285,7 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
         self.model = None
         self.bpyObjects = None
         self.cache.clear()
+        clearStringTags()
 
     @profile('writeToFile', 0)
     def writeToFile(self):
@@ -359,6 +368,15 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
             need_colors = colorMap is not None
             need_uvs = self.include_uvs and blMesh.uv_layers is not None and len(blMesh.uv_layers) > 0
 
+            # Attribute factories are looked up once, not per loop
+            positionOf = VertexAttributes.POSITION.of
+            normalOf = VertexAttributes.NORMAL.of
+            tangentOf = VertexAttributes.TANGENT.of
+            binormalOf = VertexAttributes.BINORMAL.of
+            colorOf = VertexAttributes.COLOR.of
+            texCoordOfs = [VertexAttributes.of(VertexAttributes.TEXCOORD0.id + i).of
+                           for i in range(len(blMesh.uv_layers))] if need_uvs else None
+
             meshPartIndex = 0
             for blMaterialIndex in range(len(blMesh.materials)):
                 utils.info("  [{:>2}/{:>2}]: {:s}", blMaterialIndex, len(blMesh.materials), blMesh.materials[blMaterialIndex].name)
@@ -385,7 +403,7 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
 
                             ############
                             # Vertex position is the minimal attribute
-                            attribute = VertexAttributes.POSITION.of(wrVertex.pos, blLoop.vertex_index)
+                            attribute = positionOf(wrVertex.pos)
                             vertex.add(attribute)
                             ############
 
@@ -394,16 +412,16 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
                             # if we want tangent and binormals then we'll be also using split normals, which
                             # will be exported next section
                             if gen_tangents:
-                                vertex.add(VertexAttributes.NORMAL.of(blLoop.normal[0:3]))
-                                vertex.add(VertexAttributes.TANGENT.of(blLoop.tangent[0:3], 0))
-                                vertex.add(VertexAttributes.BINORMAL.of(blLoop.bitangent[0:3], 0))
+                                vertex.add(normalOf(blLoop.normal[0:3]))
+                                vertex.add(tangentOf(blLoop.tangent[0:3]))
+                                vertex.add(binormalOf(blLoop.bitangent[0:3]))
                             ############
 
                             ############
                             # Read normals. We also determine if we'll user per-face (flat shading)
                             # or per-vertex normals (gouraud shading) here.
                             elif gen_normals:
-                                vertex.add(VertexAttributes.NORMAL.of(blLoop.normal[0:3]))
+                                vertex.add(normalOf(blLoop.normal[0:3]))
                             ############
 
                             ############
@@ -412,7 +430,7 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
                                 color = [None, None, None, 1.0]
                                 color[0], color[1], color[2] = colorMap.data[loopIndex].color
 
-                                attribute = VertexAttributes.COLOR.of(color)
+                                attribute = colorOf(color)
                                 vertex.add(attribute)
                             ############
 
@@ -423,7 +441,7 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
                                 for uv in blMesh.uv_layers:
                                     # We need to flip UV's because Blender use bottom-left as Y=0 and G3D use top-left
                                     flippedUV = [uv.data[loopIndex].uv[0], 1.0 - uv.data[loopIndex].uv[1]]
-                                    vertex.add(VertexAttributeObj(VertexAttributes.TEXCOORD0.id + texCoordCount, flippedUV))
+                                    vertex.add(texCoordOfs[texCoordCount](flippedUV))
                                     texCoordCount += 1
                             ############
 
@@ -434,7 +452,6 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
                                     vertex.addBlendWeight(wrGroup.map[g[0]], g[1])
                             ############
 
-                            vertex.rehash()
                             meshPart.addIndex(mesh.addVertex(vertex))
                     mesh.addPart(meshPart)
 
@@ -445,7 +462,8 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
             elif gen_normals:
                 blMesh.free_normals_split()
 
-            mesh.normalizeAttributes(self.bones_per_vert_mod)
+            mesh.normalizeAttributes(self.bones_per_vert_mod, self.pack_bone_weights)
+            mesh.finalizeVertices()
 
             if not mesh.isEmpty():
                 meshes.append(mesh)
@@ -769,6 +787,14 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
 
     @profile('splitVertices', 1)
     def splitVertices(self, blMesh, blMaterialIndex, vertices, maxBones):
+        if not self.include_bones or not any(vert.blendWeights for vert in vertices):
+            # Without blend weights every polygon fits into a single group
+            materialIndices = np.empty(len(blMesh.polygons), dtype=np.int32)
+            blMesh.polygons.foreach_get("material_index", materialIndices)
+            polygonsGroup = np.where(materialIndices == blMaterialIndex, 0, -1)
+            groups = [ExportQAM.Group(maxBones)] if (polygonsGroup == 0).any() else []
+            return groups, polygonsGroup
+
         groups = []
         polygonsGroup = [-1] * len(blMesh.polygons)
 
@@ -815,15 +841,28 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
 
     @profile('getTransformFromBone', 2)
     def getTransformFromBone(self, bone):
-        """Create a transform matrix based on the relative rest position of a bone"""
-
-        if bone.parent is None:
-            return bone.matrix_local
-        else:
-            return bone.parent.matrix_local.inverted() @ bone.matrix_local
+        """Create a transform based on the relative rest position of a bone"""
+
+        key = bone.as_pointer()
+        restTransform = self.cache.rests.get(key, None)
+        if restTransform is None:
+            # Rest matrices of bones are rigid, so the relative transform is composed
+            # from translations and quaternions instead of inverting the parent matrix
+            translation, rotation, _ = bone.matrix_local.decompose()
+            if bone.parent is not None:
+                parentTranslation, parentRotation, _ = bone.parent.matrix_local.decompose()
+                parentRotation = parentRotation.conjugated()
+                translation = parentRotation @ (translation - parentTranslation)
+                rotation = parentRotation @ rotation
+            # Keep the same hemisphere as quaternions decomposed from matrices
+            if rotation.w < 0.0:
+                rotation.negate()
+            restTransform = ExportQAM.RestTransform(translation, rotation)
+            self.cache.rests[key] = restTransform
+        return restTransform
 
     def splitFCurves(self, action):
-        out = {}
+        out = defaultdict(dict)
 
         for fcurve in action.fcurves:
             path = fcurve.data_path
@@ -833,11 +872,7 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
             bone = path[12:path.index('"', 13)]
             prop = path[path.rindex('.') + 1:]
 
-            node = out.get(bone, None)
-            if node is None:
-                node = {}
-                out[bone] = node
-
+            node = out[bone]
             array = node.get(prop, None)
             if array is None:
                 if prop == 'location':
@@ -881,24 +916,22 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
 
         return returnedFCurves
 
-    @profile('createTransformMatrix', 2)
-    def createTransformMatrix(self, locationVector, quaternionVector, scaleVector):
-        """Create a transform matrix from a location vector, a rotation quaternion and a scale vector"""
+    @profile('applyRestTransform', 2)
+    def applyRestTransform(self, restTransform, locationVector, quaternionVector, scaleVector):
+        """Compose the rest transform of a bone with a location vector, a rotation quaternion and a scale vector"""
 
         if isinstance(quaternionVector, mathutils.Quaternion):
             quat = quaternionVector.normalized()
         else:
-            quat = mathutils.Quaternion(quaternionVector).normalized()
-
-        translationMatrix = mathutils.Matrix(((0, 0, 0, locationVector[0]), (0, 0, 0, locationVector[1]), (0, 0, 0, locationVector[2]), (0, 0, 0, 0)))
-
-        rotationMatrix = quat.to_matrix().to_4x4()
-
-        scaleMatrix = mathutils.Matrix(((scaleVector[0], 0, 0, 0), (0, scaleVector[1], 0, 0), (0, 0, scaleVector[2], 0), (0, 0, 0, 1)))
+            quat = mathutils.Quaternion(utils.fastNormalizeQuaternion(quaternionVector))
 
-        matrix = (rotationMatrix @ scaleMatrix) + translationMatrix
+        translation = restTransform.translation + restTransform.rotation @ mathutils.Vector(locationVector[0:3])
+        rotation = restTransform.rotation @ quat
+        # Keep the same hemisphere as quaternions decomposed from matrices
+        if rotation.w < 0.0:
+            rotation.negate()
 
-        return matrix
+        return translation, rotation, scaleVector
 
     @profile('createKeyframe', 2)
     def createKeyframe(self, curves, frameNumber, restTransform):
@@ -937,8 +970,7 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
             if scaleFCurve[2] is not None:
                 scaleVector[2] = scaleFCurve[2].evaluate(frameNumber)
 
-        poseTransform = self.createTransformMatrix(translationVector, rotationVector, scaleVector)
-        translationVector, rotationVector, scaleVector = (restTransform @ poseTransform).decompose()
+        translationVector, rotationVector, scaleVector = self.applyRestTransform(restTransform, translationVector, rotationVector, scaleVector)
 
         # If one of the transform attributes had to be evaluated above then this
         # is a keyframe, otherwise it's on rest pose and we don't need the keyframe
@@ -954,34 +986,35 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
         else:
             elementSize = 4
 
-        points = array([array(p.value + [p.keytime]) for p in separateList])
+        points = np.empty((len(separateList), elementSize), dtype=np.float64)
+        for i, p in enumerate(separateList):
+            points[i, :-1] = p.value
+            points[i, -1] = p.keytime
+
+        # Tracks resting on the default value for the whole action are dropped
+        default = (utils.DEFAULT_TRANSLATION, utils.DEFAULT_ROTATION, utils.DEFAULT_SCALE)[type]
+        if (np.abs(points[:, :-1] - default) <= utils.FROUND_VALUE).all():
+            return []
+
         approx = Approximator(elementSize)
         indices = approx.approximate(points, err)
-        out = [separateList[i] for i in indices]
-
-        if len(out) == 2:
-            out0 = out[0].value
-            out1 = out[1].value
-            for i in range(1, elementSize - 1):
-                if utils.limitFloatPrecision(out0[i]) != utils.limitFloatPrecision(out1[i]):
-                    return out
-
-            if type == 0:
-                if utils.testDefaultTransform(out0):
-                    return []
-            elif type == 1:
-                if utils.testDefaultQuaternion(out0):
-                    return []
-            elif type == 2:
-                if utils.testDefaultScale(out0):
-                    return []
-
-            out.pop()
-        return out
+
+        if len(indices) == 2:
+            kept = points[indices]
+            rounded = np.round(kept[:, 1:-1], utils.FROUND)
+            if (rounded[0] != rounded[1]).any():
+                return [separateList[i] for i in indices]
+
+            if (np.abs(kept[0, :-1] - default) <= utils.FROUND_VALUE).all():
+                return []
+
+            return [separateList[indices[0]]]
+        return [separateList[i] for i in indices]
 
     class Cache:
         def __init__(self):
             self.groups_dict = {}
+            self.rests = {}
             self.tasks = []
             self.dispose_nodes = []
 
@@ -995,6 +1028,7 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
 
         def clear(self):
             self.groups_dict.clear()
+            self.rests.clear()
 
             for task in self.tasks:
                 task()
@@ -1005,6 +1039,16 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
                 bpy.data.objects.remove(it)
                 bpy.data.meshes.remove(it.data)
 
+    class RestTransform:
+        """Rigid rest transform of a bone, stored as translation and rotation"""
+
+        def __init__(self, translation, rotation):
+            self.translation = translation
+            self.rotation = rotation
+
+        def decompose(self):
+            return self.translation.copy(), self.rotation.copy(), mathutils.Vector((1.0, 1.0, 1.0))
+
     def setupAxisConversion(self, axisForward, axisUp):
         # W for quaternions takes from blender W which is index 0
         self.vector4AxisMapper[3][0] = 0
@@ -1187,18 +1231,16 @@ class ExportQAM(bpy.types.Operator, ExportHelper):
             self.blendWeights = []
 
         def setGroups(self, groups, max):
-            filtered = list(map(lambda x: [x.group, x.weight], filter(lambda x: not utils.is0(x.weight), groups)))
+            filtered = [[g.group, g.weight] for g in groups if not utils.is0(g.weight)]
             if len(filtered) > max:
-                filtered.sort(key=lambda x: x[1])
-                filtered = filtered[0:max]
-
-            blendSum = 0.0
-            for i in range(len(filtered)):
-                blendSum += filtered[i][1]
+                # Keep the heaviest influences, the sort is stable for equal weights
+                filtered.sort(key=lambda x: x[1], reverse=True)
+                del filtered[max:]
 
+            blendSum = sum(g[1] for g in filtered)
             if not utils.is1(blendSum):
-                for i in range(len(filtered)):
-                    filtered[i][1] /= blendSum
+                for g in filtered:
+                    g[1] /= blendSum
 
             self.blendWeights = filtered
 
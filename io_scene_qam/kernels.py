@@ -0,0 +1,132 @@
+import numpy as np
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        '''Fallback for environments without numba, e.g. the Python bundled with Blender.'''
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda fun: fun
+
+__all__ = (
+    'HAS_NUMBA', 'njit', 'uniqueRows', 'maxLineError'
+)
+
+# numba's on-disk cache records the module name of the kernels, so only the add-on
+# package caches them. The keyframe viewer imports this file as the top-level `kernels`.
+CACHE = bool(__package__)
+
+FNV_OFFSET = 0xcbf29ce484222325
+FNV_PRIME = 0x100000001b3
+
+@njit(cache=CACHE)
+def _fnv1a(rows, i):
+    """FNV-1a hash of the 32-bit words of one row"""
+    h = np.uint64(FNV_OFFSET)
+    for j in range(rows.shape[1]):
+        h = (h ^ np.uint64(rows[i, j])) * np.uint64(FNV_PRIME)
+    return h
+
+@njit(cache=CACHE)
+def _uniqueRowsJit(rows):
+    count, stride = rows.shape
+    size = 16
+    while size < count * 2:
+        size <<= 1
+    mask = np.uint64(size - 1)
+
+    # Open addressed table of unique row numbers, keyed by FNV-1a of the row words
+    table = np.full(size, -1, dtype=np.int64)
+    first = np.empty(count, dtype=np.int64)
+    inverse = np.empty(count, dtype=np.int64)
+    unique = 0
+    for i in range(count):
+        slot = _fnv1a(rows, i) & mask
+        while True:
+            k = table[slot]
+            if k < 0:
+                table[slot] = unique
+                first[unique] = i
+                inverse[i] = unique
+                unique += 1
+                break
+
+            r = first[k]
+            equal = True
+            for j in range(stride):
+                if rows[r, j] != rows[i, j]:
+                    equal = False
+                    break
+            if equal:
+                inverse[i] = k
+                break
+            slot = (slot + np.uint64(1)) & mask
+
+    return first[:unique], inverse
+
+def _uniqueRowsNumpy(rows):
+    keys = rows.view(np.dtype((np.void, rows.itemsize * rows.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    # Keep rows in the order of their first occurrence
+    order = np.argsort(first)
+    remap = np.empty(len(order), dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    return first[order], remap[inverse.ravel()]
+
+def uniqueRows(arr):
+    """
+    Finds equal rows of a 2D array of 4 byte items by comparing their bytes.
+
+    Returns the indices of the first occurrence of every unique row, in order,
+    and the index into those for every row of the array.
+    """
+    rows = np.ascontiguousarray(arr).view(np.uint32)
+    if HAS_NUMBA:
+        return _uniqueRowsJit(rows)
+    return _uniqueRowsNumpy(rows)
+
+@njit(cache=CACHE)
+def maxLineError(points, init, end):
+    """
+    Finds the point between rows `init` and `end` of a 2D float array that lies
+    farthest from the segment joining them.
+
+    Returns its row, or -1 if all points lie on the segment, and its squared distance.
+    """
+    dim = points.shape[1]
+    pd = np.empty(dim)
+    dsq = 0.0
+    for k in range(dim):
+        pd[k] = points[end, k] - points[init, k]
+        dsq += pd[k] * pd[k]
+
+    index = -1
+    maxValue = 0.0
+    if dsq == 0:
+        return index, maxValue
+
+    for i in range(init + 1, end):
+        u = 0.0
+        for k in range(dim):
+            u += (points[i, k] - points[init, k]) * pd[k]
+        u /= dsq
+
+        sqDis = 0.0
+        for k in range(dim):
+            if u <= 0:
+                d = points[i, k] - points[init, k]
+            elif u >= 1:
+                d = points[i, k] - points[end, k]
+            else:
+                d = points[i, k] - (points[init, k] + u * pd[k])
+            sqDis += d * d
+
+        if sqDis > maxValue:
+            maxValue = sqDis
+            index = i
+    return index, maxValue
@@ -1,6 +1,9 @@
 import math
-import struct
-from . import utils
+import numpy as np
+from array import array
+from itertools import chain
+from .kernels import uniqueRows
+from .utils import DEFAULT_TRANSLATION, DEFAULT_ROTATION, DEFAULT_SCALE
 from .profiler import profile
 from .nbt import (
     NBTSerializable,
@@ -16,9 +19,24 @@ from .nbt import (
 __all__ = (
     'QamModel', 'VertexAttributes', 'VertexAttribute', 'VertexAttributeObj',
     'Vertex', 'Mesh', 'MeshPart', 'Node', 'NodePart', 'Bone', 'Texture',
-    'Material', 'Animation', 'NodeAnimation', 'Keyframe', 'KeyframeSeparate'
+    'Material', 'Animation', 'NodeAnimation', 'Keyframe', 'KeyframeSeparate',
+    'clearStringTags'
 )
 
+# Tags of strings that repeat across the model, like attribute names, types and bone names.
+# Cleared after every export, as it also holds names from the scene.
+STRING_TAG_CACHE = {}
+
+def stringTag(value):
+    tag = STRING_TAG_CACHE.get(value, None)
+    if tag is None:
+        tag = NBTTagString(value)
+        STRING_TAG_CACHE[value] = tag
+    return tag
+
+def clearStringTags():
+    STRING_TAG_CACHE.clear()
+
 class QamModel(NBTSerializable):
     __slots__ = ('meshes', 'materials', 'nodes', 'animations')
 
@@ -59,28 +77,32 @@ class VertexAttribute:
         self.id = id
         map[id] = self
 
-    def init(self, list, obj):
+    def init(self, list, count):
         list.append(self.name)
 
-    def of(self, value, hash=None):
-        return VertexAttributeObj(self.id, value, hash)
+    def of(self, value):
+        return VertexAttributeObj(self.id, value)
 
 class VertexAttributeBoneIndices(VertexAttribute):
+    __slots__ = ('names',)
+
+    def __init__(self, name, id, map):
+        super().__init__(name, id, map)
+        self.names = {}
+
+    def init(self, list, count):
+        names = self.names.get(count, None)
+        if names is None:
+            names = self.names[count] = self.createNames(count)
+        list.extend(names)
 
-    def init(self, list, obj):
-        count = len(obj.value)
-        for i in range(0, count):
-            list.append(self.name + str(i))
+    def createNames(self, count):
+        return tuple(self.name + str(i) for i in range(0, count))
 
-class VertexAttributeBoneWeights(VertexAttribute):
+class VertexAttributeBoneWeights(VertexAttributeBoneIndices):
 
-    def init(self, list, obj):
-        idx = 0
-        count = len(obj.value)
-        while count > 0:
-            list.append('{}{}{}'.format(self.name, idx, min(count, 4)))
-            idx += 1
-            count -= 4
+    def createNames(self, count):
+        return tuple('{}{}{}'.format(self.name, idx, min(count - idx * 4, 4)) for idx in range((count + 3) // 4))
 
 class VertexAttributes(object):
     ATTRIBUTE_MAP = {}
@@ -102,10 +124,9 @@ class VertexAttributes(object):
     TEXCOORD9 = VertexAttribute('TEXCOORD9', 69, ATTRIBUTE_MAP)
     BONEINDICES = VertexAttributeBoneIndices('BONEINDICES', 70, ATTRIBUTE_MAP)
     BONEWEIGHTS = VertexAttributeBoneWeights('BONEWEIGHTS', 80, ATTRIBUTE_MAP)
+    BONEWEIGHTSPACKED = VertexAttributeBoneIndices('BONEWEIGHTSPACKED', 81, ATTRIBUTE_MAP)
 
-    @staticmethod
-    def of(type):
-        return VertexAttributes.ATTRIBUTE_MAP[type]
+    of = staticmethod(ATTRIBUTE_MAP.__getitem__)
 
     @staticmethod
     def name(type):
@@ -113,41 +134,16 @@ class VertexAttributes(object):
 
     @staticmethod
     def isTexCoord(id):
-        return VertexAttributes.TEXCOORD0.id <= type and type <= VertexAttributes.TEXCOORD9.id
+        return VertexAttributes.TEXCOORD0.id <= id <= VertexAttributes.TEXCOORD9.id
 
 # end VertexAttributes
 
 class VertexAttributeObj:
-    __slots__ = ('type', 'value', 'hash')
+    __slots__ = ('type', 'value')
 
-    def __init__(self, type, value, hash=None):
+    def __init__(self, type, value):
         self.type = type
         self.value = value
-        if hash is None:
-            self.rehash()
-        else:
-            self.hash = hash
-
-    @profile('rehashVertexAttribute', 3)
-    def rehash(self):
-        self.hash = 81 * self.type + utils.hashList(self.value)
-
-    def __hash__(self):
-        return self.hash
-
-    def __eq__(self, another):
-        """Compare this attribute with another for value"""
-        if len(self.value) != len(another.value):
-            return False
-
-        for pos in range(0, len(self.value)):
-            if self.value[pos] != another.value[pos]:
-                return False
-
-        return True
-
-    def __ne__(self, another):
-        return not self.__eq__(another)
 
     def __repr__(self):
         value = "{!s} {!r}".format(VertexAttributes.of(self.type).name, self.value)
@@ -156,13 +152,12 @@ class VertexAttributeObj:
 # end VertexAttributeObj
 
 class Vertex(NBTSerializable):
-    __slots__ = ('attributes', 'attrBoneIndices', 'attrBoneWeights', 'hash')
+    __slots__ = ('attributes', 'attrBoneIndices', 'attrBoneWeights')
 
     def __init__(self):
         self.attributes = []
         self.attrBoneIndices = None
         self.attrBoneWeights = None
-        self.hash = None
 
     def add(self, attribute):
         self.attributes.append(attribute)
@@ -176,24 +171,6 @@ class Vertex(NBTSerializable):
         self.attrBoneWeights.value.append(weight)
         self.attrBoneIndices.value.append(int(idx))
 
-    @profile('rehashVertex', 3)
-    def rehash(self):
-        self.hash = utils.hashList(self.attributes)
-
-    @profile('hashVertex', 3)
-    def __hash__(self):
-        return self.hash
-
-    @profile('eqVertex', 3)
-    def __eq__(self, another):
-        for pos in range(len(self.attributes)):
-            if self.attributes[pos] != another.attributes[pos]:
-                return False
-        return True
-
-    def __ne__(self, another):
-        return not self.__eq__(another)
-
     def __repr__(self):
         reprStr = "{ "
 
@@ -212,81 +189,154 @@ class Vertex(NBTSerializable):
 # end Vertex
 
 class Mesh(NBTSerializable):
-    __slots__ = ('id', 'vertices', 'parts', 'attributes', 'vertexIndices')
+    __slots__ = ('id', 'vertices', 'parts', 'attributes', 'buffers')
 
     def __init__(self):
         self.id = ""
         self.vertices = []
         self.parts = []
         self.attributes = []
-        self.vertexIndices = {}
+        self.buffers = {}
 
     def isEmpty(self):
         return len(self.attributes) == 0 or len(self.parts) == 0 or len(self.vertices) == 0
 
     @profile('addVertex', 3)
     def addVertex(self, vertex):
-        idx = self.vertexIndices.get(vertex, -1)
-        if idx < 0:
-            self.vertices.append(vertex)
-            idx = len(self.vertices) - 1
-            self.vertexIndices[vertex] = idx
-        return idx
+        """Stages a vertex, duplicates are merged later by finalizeVertices"""
+        self.vertices.append(vertex)
+        return len(self.vertices) - 1
 
     def addPart(self, meshPart):
         self.parts.append(meshPart)
         meshPart.parentMesh = self
 
     @profile('normalizeAttributes', 2)
-    def normalizeAttributes(self, mod):
-        if len(self.vertices) > 0:
-           self.attributes = [it.type for it in self.vertices[0].attributes]
-
-        attrColorInx = -1
-        for i in range(len(self.attributes)):
-            if self.attributes[i] == VertexAttributes.COLOR.id:
-                attrColorInx = i
-
-        bonesCount = 0
-        for it in self.vertices:
-            if it.attrBoneWeights is not None and bonesCount < len(it.attrBoneWeights.value):
-                bonesCount = len(it.attrBoneWeights.value)
-
-        if bonesCount > 0:
-            bonesCount = ((bonesCount - 1) // mod * mod) + mod
-
-            indicesCount = ((bonesCount - 1) >> 2 << 2) + 4
-            indicesFmtPack = '>{}B'.format(indicesCount)
-            indicesFmtUnpack = '>{}f'.format(indicesCount // 4)
-
-            for vert in self.vertices:
-                for i in range(bonesCount - len(vert.attrBoneIndices.value)):
-                    vert.attrBoneIndices.value.append(0)
-                    vert.attrBoneWeights.value.append(0.0)
-                for i in range(indicesCount - len(vert.attrBoneIndices.value)):
-                    vert.attrBoneIndices.value.append(0)
-
-                tmp = struct.pack(indicesFmtPack, *vert.attrBoneIndices.value[::-1])
-                vert.attrBoneIndices.value = struct.unpack(indicesFmtUnpack, tmp)
-
-        if attrColorInx >= 0:
-            for vert in self.vertices:
-                attr = vert.attributes[attrColorInx]
-                tmp = struct.pack('>4B', *[int(it * 255) for it in attr.value[::-1]])
-                attr.value = struct.unpack('>f', tmp)
+    def normalizeAttributes(self, mod, packWeights=False):
+        """
+        Gathers the staged vertices into one buffer per attribute type.
+        Colors and bone indices are packed into floats, values of the staged vertices are left as is.
+        """
+        self.buffers = {}
+        if len(self.vertices) == 0:
+            return
+
+        self.attributes = [it.type for it in self.vertices[0].attributes]
+
+        # Attributes of a fixed width are read in one pass and split into column views
+        columns = [i for i, type in enumerate(self.attributes)
+                   if type != VertexAttributes.BONEINDICES.id and type != VertexAttributes.BONEWEIGHTS.id]
+        widths = [len(self.vertices[0].attributes[i].value) for i in columns]
+        count = len(self.vertices)
+        values = np.fromiter(
+            chain.from_iterable(vert.attributes[i].value for vert in self.vertices for i in columns),
+            dtype=np.float64, count=count * sum(widths)
+        ).reshape(count, -1)
+
+        offset = 0
+        for i, width in zip(columns, widths):
+            self.buffers[self.attributes[i]] = values[:, offset:offset + width]
+            offset += width
+
+        if VertexAttributes.BONEWEIGHTS.id in self.attributes:
+            self.normalizeBones(mod, packWeights)
+
+        colors = self.buffers.get(VertexAttributes.COLOR.id)
+        if colors is not None:
+            # Colors are quantized to bytes and packed into one float
+            quantized = np.clip(colors * 255.0, 0, 255).astype(np.uint8)
+            self.buffers[VertexAttributes.COLOR.id] = Mesh.packBytes(quantized)
+
+        for type, buffer in self.buffers.items():
+            self.buffers[type] = buffer.astype(np.float32, copy=False)
+
+    def normalizeBones(self, mod, packWeights):
+        weightValues = [vert.attrBoneWeights.value for vert in self.vertices]
+        indexValues = [vert.attrBoneIndices.value for vert in self.vertices]
+
+        # Every vertex has as many bone indices as weights, one scan gives both the row sizes and the bones count
+        counts = np.fromiter(map(len, weightValues), dtype=np.intp, count=len(weightValues))
+        bonesCount = int(counts.max())
+
+        # Round up to a multiple of mod, which usually is a power of two, and indices to a multiple of four
+        mod = max(mod, 1)
+        if mod & (mod - 1) == 0:
+            bonesCount = (bonesCount + mod - 1) & -mod
+        else:
+            bonesCount = (bonesCount + mod - 1) // mod * mod
+        indicesCount = (bonesCount + 3) & -4
+
+        # Missing bones are padded with zero weights and indices
+        weights = Mesh.gatherRows(weightValues, counts, bonesCount, np.float64)
+        indices = Mesh.gatherRows(indexValues, counts, indicesCount, np.uint8)
+
+        # Every four bone indices are packed as bytes into one float
+        self.buffers[VertexAttributes.BONEINDICES.id] = Mesh.packBytes(indices)
+
+        if packWeights and bonesCount > 0:
+            inx = self.attributes.index(VertexAttributes.BONEWEIGHTS.id)
+            self.attributes[inx] = VertexAttributes.BONEWEIGHTSPACKED.id
+            self.buffers[VertexAttributes.BONEWEIGHTSPACKED.id] = Mesh.packBoneWeights(weights, indicesCount)
+        else:
+            self.buffers[VertexAttributes.BONEWEIGHTS.id] = weights
+
+    @staticmethod
+    def gatherRows(values, counts, width, dtype):
+        """Copies sequences with the given lengths into the rows of a zero padded array"""
+        rows = np.zeros((len(values), width), dtype=dtype)
+        rows[np.arange(width) < counts[:, None]] = np.fromiter(chain.from_iterable(values), dtype=dtype, count=counts.sum())
+        return rows
+
+    @staticmethod
+    def packBytes(values):
+        """Packs every four bytes of the rows into one big-endian float, the first byte is the lowest one"""
+        # Reversing the bytes of a row equals reading them as little-endian floats in reversed order, both are views
+        return np.ascontiguousarray(values).view('<f4')[:, ::-1].astype(np.float32)
+
+    @staticmethod
+    def packBoneWeights(weights, indicesCount):
+        """Quantizes bone weights to normalized bytes, four weights are packed into one float"""
+        quantized = np.zeros((len(weights), indicesCount), dtype=np.int64)
+        quantized[:, :weights.shape[1]] = np.round(weights * 255.0)
+
+        # Give the rounding error to the heaviest weight so every vertex sums up to 255
+        rows = np.arange(len(weights))
+        heaviest = np.argmax(weights, axis=1)
+        error = np.where(weights.sum(axis=1) > 0.0, 255 - quantized.sum(axis=1), 0)
+        quantized[rows, heaviest] += error
+
+        return Mesh.packBytes(np.clip(quantized, 0, 255).astype(np.uint8))
+
+    def packBuffers(self):
+        """Interleaves the attribute buffers into one row per vertex"""
+        return np.hstack([self.buffers[type] for type in self.attributes])
+
+    @profile('finalizeVertices', 2)
+    def finalizeVertices(self):
+        """Merges equal vertices and remaps the indices of all parts"""
+        if len(self.buffers) == 0:
+            return
+
+        # Compare whole rows by their bytes, packed colors and bone indices may be NaN
+        first, remap = uniqueRows(self.packBuffers())
+
+        self.vertices = [self.vertices[i] for i in first]
+        for type, buffer in self.buffers.items():
+            self.buffers[type] = buffer[first]
+        for part in self.parts:
+            if part.indices is not None and len(part.indices) > 0:
+                indices = remap[np.frombuffer(part.indices, dtype=np.uint32)]
+                part.indices = array('I', indices.astype(np.uint32).tobytes())
 
     def packNBT(self):
         attr_names = []
-        for i in range(len(self.attributes)):
-            attr = VertexAttributes.of(self.attributes[i])
-            attr.init(attr_names, self.vertices[0].attributes[i])
-
-        verts = [v for vert in self.vertices for attr in vert.attributes for v in attr.value]
+        for type in self.attributes:
+            VertexAttributes.of(type).init(attr_names, self.buffers[type].shape[1])
 
         nbt = NBTTagCompound()
         nbt['id'] = NBTTagString(self.id)
-        nbt['attributes'] = NBTTagList(NBTTagString, [NBTTagString(it) for it in attr_names])
-        nbt['vertices'] = NBTTagFloatArray(verts)
+        nbt['attributes'] = NBTTagList(NBTTagString, [stringTag(it) for it in attr_names])
+        nbt['vertices'] = NBTTagFloatArray.from_bytes(self.packBuffers())
         nbt['parts'] = NBTTagList(NBTTagCompound, [it.packNBT() for it in self.parts])
         return nbt
 
@@ -297,28 +347,25 @@ class Mesh(NBTSerializable):
 # end Mesh
 
 class MeshPart(NBTSerializable):
-    __slots__ = ('id', 'type', 'indices', 'parentMesh', 'maxIndex')
+    __slots__ = ('id', 'type', 'indices', 'parentMesh')
 
     def __init__(self, id="", type="TRIANGLES", indices=None, parentMesh=None):
         self.id = id
         self.type = type
-        self.indices = indices
+        self.indices = array('I', indices) if indices is not None else None
         self.parentMesh = parentMesh
-        self.maxIndex = 0
 
     def addIndex(self, value):
         if self.indices is None:
-            self.indices = []
+            self.indices = array('I')
         self.indices.append(value)
-        if value > self.maxIndex:
-            self.maxIndex = value
 
     def packNBT(self):
         nbt = NBTTagCompound()
         nbt['id'] = NBTTagString(self.id)
-        nbt['type'] = NBTTagString(self.type)
+        nbt['type'] = stringTag(self.type)
         if self.indices is not None:
-            if self.maxIndex >= 1 << 16:
+            if len(self.indices) > 0 and np.frombuffer(self.indices, dtype=np.uint32).max() >= 1 << 16:
                 nbt['indices'] = NBTTagIntArray(self.indices)
             else:
                 nbt['indices'] = NBTTagUShortArray(self.indices)
@@ -358,10 +405,11 @@ class Node(NBTSerializable):
         self.children.append(value)
 
     def packNBT(self):
-        transform = []
-        transform.extend(self.translation if self.translation != None else [0.0, 0.0, 0.0])
-        transform.extend(self.rotation if self.rotation != None else [0.0, 0.0, 0.0, 1.0])
-        transform.extend(self.scale if self.scale != None else [1.0, 1.0, 1.0])
+        transform = array('f', (
+            *(self.translation if self.translation is not None else DEFAULT_TRANSLATION),
+            *(self.rotation if self.rotation is not None else DEFAULT_ROTATION),
+            *(self.scale if self.scale is not None else DEFAULT_SCALE)
+        ))
 
         nbt = NBTTagCompound()
         nbt['id'] = NBTTagString(self.id)
@@ -390,7 +438,7 @@ class NodePart(NBTSerializable):
     def packNBT(self):
         nbt = NBTTagCompound()
         nbt['meshPartId'] = NBTTagString(self.meshPartId)
-        nbt['materialId'] = NBTTagString(self.materialId)
+        nbt['materialId'] = stringTag(self.materialId)
         if self.bones is not None:
             nbt['bones'] = NBTTagList(NBTTagCompound, [it.packNBT() for it in self.bones])
         return nbt
@@ -407,13 +455,14 @@ class Bone(NBTSerializable):
         self.scale = None
 
     def packNBT(self):
-        transform = []
-        transform.extend(self.translation if self.translation != None else [0.0, 0.0, 0.0])
-        transform.extend(self.rotation if self.rotation != None else [0.0, 0.0, 0.0, 1.0])
-        transform.extend(self.scale if self.scale != None else [1.0, 1.0, 1.0])
+        transform = array('f', (
+            *(self.translation if self.translation is not None else DEFAULT_TRANSLATION),
+            *(self.rotation if self.rotation is not None else DEFAULT_ROTATION),
+            *(self.scale if self.scale is not None else DEFAULT_SCALE)
+        ))
 
         nbt = NBTTagCompound()
-        nbt['node'] = NBTTagString(self.node)
+        nbt['node'] = stringTag(self.node)
         nbt['transform'] = NBTTagFloatArray(transform)
         return nbt
 
@@ -431,7 +480,7 @@ class Texture(NBTSerializable):
         nbt = NBTTagCompound()
         nbt['id'] = NBTTagString(self.id)
         nbt['fileName'] = NBTTagString(self.filename)
-        nbt['type'] = NBTTagString(self.type)
+        nbt['type'] = stringTag(self.type)
         return nbt
 
 # end Texture
@@ -514,7 +563,7 @@ class NodeAnimation(NBTSerializable):
 
     def packNBT(self):
         nbt = NBTTagCompound()
-        nbt['boneId'] = NBTTagString(self.boneId)
+        nbt['boneId'] = stringTag(self.boneId)
         if self.keyframes is not None:
             nbt['keyFrames'] = NBTTagList(NBTTagFloatArray, [it.packNBT() for it in self.keyframes])
         if self.translation is not None:
@@ -546,11 +595,12 @@ class Keyframe(NBTSerializable):
         return KeyframeSeparate(self.keytime, self.scale)
 
     def packNBT(self):
-        list = [self.keytime]
-        list.extend(self.translation if self.translation is not None else [0.0, 0.0, 0.0])
-        list.extend(self.rotation if self.rotation is not None else [0.0, 0.0, 0.0, 1.0])
-        list.extend(self.scaling if self.scaling is not None else [1.0, 1.0, 1.0])
-        return NBTTagFloatArray(list)
+        return NBTTagFloatArray(array('f', (
+            self.keytime,
+            *(self.translation if self.translation is not None else DEFAULT_TRANSLATION),
+            *(self.rotation if self.rotation is not None else DEFAULT_ROTATION),
+            *(self.scaling if self.scaling is not None else DEFAULT_SCALE)
+        )))
 
 # end Keyframe
 
@@ -562,8 +612,6 @@ class KeyframeSeparate(NBTSerializable):
         self.value = value
 
     def packNBT(self):
-        list = [self.keytime]
-        list.extend(self.value)
-        return NBTTagFloatArray(list)
+        return NBTTagFloatArray(array('f', (self.keytime, *self.value)))
 
 # end KeyframeSeparate
@@ -12,7 +12,111 @@ __all__ = (
     'NBTTagIntArray', 'NBTTagLongArray', 'NBTTagShortArray', 'NBTTagFloatArray'
 )
 
-from struct import unpack, pack
+import sys
+from array import array
+from functools import lru_cache
+from io import StringIO
+from struct import Struct
+
+@lru_cache(maxsize=256)
+def _struct_be(fmt):
+    """Compiled big-endian `Struct` for `fmt`, shared by all files."""
+    return Struct('>' + fmt)
+
+@lru_cache(maxsize=256)
+def _struct_le(fmt):
+    """Compiled little-endian `Struct` for `fmt`, shared by all files."""
+    return Struct('<' + fmt)
+
+def _float32_repr(value):
+    """Shortest repr of `value` that reads back as the same 32-bit float."""
+    if value != value or value in (float('inf'), float('-inf')):
+        return repr(value)
+    pack = _struct_be('f').pack
+    try:
+        packed = pack(value)
+    except OverflowError:
+        return repr(value)
+    for precision in range(1, 10):
+        short = float('%.*g' % (precision, value))
+        if pack(short) == packed:
+            return repr(short)
+    return repr(value)
+
+class _Reader(object):
+    """
+    Unpacks NBT fields from an in-memory buffer, advancing `pos` past each.
+    Subclasses fix the byte order with their precompiled unpackers.
+    """
+    __slots__ = ('data', 'pos')
+    little_endian = False
+    struct = staticmethod(_struct_be)
+    unpack_i1 = _struct_be('b').unpack_from
+    unpack_i2 = _struct_be('h').unpack_from
+    unpack_i4 = _struct_be('i').unpack_from
+    unpack_i8 = _struct_be('q').unpack_from
+    unpack_f4 = _struct_be('f').unpack_from
+    unpack_f8 = _struct_be('d').unpack_from
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def __call__(self, fmt, size):
+        start = self.pos
+        self.pos = start + size
+        return self.struct(fmt).unpack_from(self.data, start)
+
+    def bytes(self, size):
+        start = self.pos
+        self.pos = start + size
+        if self.pos > len(self.data):
+            raise IOError('Unexpected end of NBTFile.')
+        return self.data[start:start + size]
+
+    def i1(self):
+        start = self.pos
+        self.pos = start + 1
+        return self.unpack_i1(self.data, start)[0]
+
+    def i2(self):
+        start = self.pos
+        self.pos = start + 2
+        return self.unpack_i2(self.data, start)[0]
+
+    def i4(self):
+        start = self.pos
+        self.pos = start + 4
+        return self.unpack_i4(self.data, start)[0]
+
+    def i8(self):
+        start = self.pos
+        self.pos = start + 8
+        return self.unpack_i8(self.data, start)[0]
+
+    def f4(self):
+        start = self.pos
+        self.pos = start + 4
+        return self.unpack_f4(self.data, start)[0]
+
+    def f8(self):
+        start = self.pos
+        self.pos = start + 8
+        return self.unpack_f8(self.data, start)[0]
+
+class _BEReader(_Reader):
+    __slots__ = ()
+
+class _LEReader(_Reader):
+    __slots__ = ()
+    little_endian = True
+    struct = staticmethod(_struct_le)
+    unpack_i1 = _struct_le('b').unpack_from
+    unpack_i2 = _struct_le('h').unpack_from
+    unpack_i4 = _struct_le('i').unpack_from
+    unpack_i8 = _struct_le('q').unpack_from
+    unpack_f4 = _struct_le('f').unpack_from
+    unpack_f8 = _struct_le('d').unpack_from
 
 class NBTType:
     END             = 0x00
@@ -33,26 +137,25 @@ class NBTType:
 
 
 class NBTBase(object):
+    __slots__ = ()
+    fmt = ''
+    tag_type = NBTType.END
+
     def __init__(self, value, name=None):
         self.value = value
 
-    @property
-    def fmt(self): return ''
-
-    @classmethod
-    def type(cls): return NBTType.END
-
     @staticmethod
     def _read_utf8(read):
         """Reads a length-prefixed UTF-8 string."""
-        name_length = read('h', 2)[0]
-        return read.io.read(name_length).decode('utf-8')
+        name_length = read.i2()
+        return str(read.bytes(name_length), 'utf-8')
 
     @staticmethod
     def _write_utf8(write, value):
         """Writes a length-prefixed UTF-8 string."""
-        write('h', len(value))
-        write.io.write(value.encode('utf-8'))
+        data = value.encode('utf-8')
+        write('h', len(data))
+        write.io.write(data)
 
     @classmethod
     def read(cls, read):
@@ -64,6 +167,10 @@ class NBTBase(object):
     def pretty(self, indent_rest=0, indent_str='  '):
         return repr(self)
 
+    def _pretty_into(self, out, indent_rest, indent_str):
+        """Writes `pretty()` into the `out` buffer of the enclosing container."""
+        out.write(self.pretty(indent_rest, indent_str))
+
     def __repr__(self):
         return '{}({!r})'.format(self.__class__.__name__, self.value)
 
@@ -74,97 +181,71 @@ class NBTBase(object):
         return unicode(repr(self), 'utf-8')
 
 class NBTTagByte(NBTBase):
-    __slots__ = ('value')
-
-    @classmethod
-    def type(cls): return NBTType.BYTE
-
-    @property
-    def fmt(self): return 'b'
+    __slots__ = ('value',)
+    tag_type = NBTType.BYTE
+    fmt = 'b'
 
     @classmethod
-    def read(cls, read): return cls(read('b', 1)[0])
+    def read(cls, read): return cls(read.i1())
 
     def pretty(self, indent_rest=0, indent_str='  '):
         return '{}B'.format(self.value)
 
 class NBTTagShort(NBTBase):
-    __slots__ = ('value')
+    __slots__ = ('value',)
+    tag_type = NBTType.SHORT
+    fmt = 'h'
 
     @classmethod
-    def type(cls): return NBTType.SHORT
-
-    @property
-    def fmt(self): return 'h'
-
-    @classmethod
-    def read(cls, read): return cls(read('h', 2)[0])
+    def read(cls, read): return cls(read.i2())
 
     def pretty(self, indent_rest=0, indent_str='  '):
         return '{}S'.format(self.value)
 
 class NBTTagInt(NBTBase):
-    __slots__ = ('value')
-
-    @classmethod
-    def type(cls): return NBTType.INT
-
-    @property
-    def fmt(self): return 'i'
+    __slots__ = ('value',)
+    tag_type = NBTType.INT
+    fmt = 'i'
 
     @classmethod
-    def read(cls, read): return cls(read('i', 4)[0])
+    def read(cls, read): return cls(read.i4())
 
 class NBTTagLong(NBTBase):
-    __slots__ = ('value')
-
-    @classmethod
-    def type(cls): return NBTType.LONG
-
-    @property
-    def fmt(self): return 'q'
+    __slots__ = ('value',)
+    tag_type = NBTType.LONG
+    fmt = 'q'
 
     @classmethod
-    def read(cls, read): return cls(read('q', 8)[0])
+    def read(cls, read): return cls(read.i8())
 
     def pretty(self, indent_rest=0, indent_str='  '):
         return '{}L'.format(self.value)
 
 class NBTTagFloat(NBTBase):
-    __slots__ = ('value')
-
-    @classmethod
-    def type(cls): return NBTType.FLOAT
-
-    @property
-    def fmt(self): return 'f'
+    __slots__ = ('value',)
+    tag_type = NBTType.FLOAT
+    fmt = 'f'
 
     @classmethod
-    def read(cls, read): return cls(read('f', 4)[0])
+    def read(cls, read): return cls(read.f4())
 
     def pretty(self, indent_rest=0, indent_str='  '):
         return '{}F'.format(self.value)
 
 class NBTTagDouble(NBTBase):
-    __slots__ = ('value')
-
-    @classmethod
-    def type(cls): return NBTType.DOUBLE
-
-    @property
-    def fmt(self): return 'd'
+    __slots__ = ('value',)
+    tag_type = NBTType.DOUBLE
+    fmt = 'd'
 
     @classmethod
-    def read(cls, read): return cls(read('d', 8)[0])
+    def read(cls, read): return cls(read.f8())
 
     def pretty(self, indent_rest=0, indent_str='  '):
         return '{}D'.format(self.value)
 
 class NBTTagString(NBTBase):
-    __slots__ = ('value')
-
-    @classmethod
-    def type(cls): return NBTType.STRING
+    __slots__ = ('value',)
+    tag_type = NBTType.STRING
 
     def write(self, write):
         self._write_utf8(write, self.value)
@@ -176,58 +257,58 @@ class NBTTagString(NBTBase):
         return '\'{}\''.format(self.value)
 
 class NBTTagEnd(NBTBase):
-    __slots__ = ('value')
+    __slots__ = ('value',)
 
     @classmethod
     def read(cls, read): return cls(read('2b', 2)[0])
 
 class NBTTagCompound(NBTBase, dict):
-    @classmethod
-    def type(cls): return NBTType.COMPOUND
+    __slots__ = ()
+    tag_type = NBTType.COMPOUND
 
     def __init__(self, value=None):
-        self.value = self
         if value is not None:
             self.update(value)
 
+    @property
+    def value(self):
+        # The compound is its own value
+        return self
+
     def write(self, write):
-        for k, v in self.value.items():
-            write('b', v.__class__.type())
-            self._write_utf8(write, k)
+        io_write = write.io.write
+        # Each entry starts with its tag type and the length of its name
+        struct = _struct_le if write.little_endian else _struct_be
+        pack_header = struct('bh').pack
+        for k, v in self.items():
+            name = k.encode('utf-8')
+            io_write(pack_header(v.tag_type, len(name)))
+            io_write(name)
             v.write(write)
         # A tag of type 0 (TAg_End) terminates a NBTTagCompound.
-        write('b', 0)
+        io_write(b'\x00')
 
     @classmethod
     def read(cls, read):
         # A NBTTagCompound is almost identical to Python's native dict()
         # object, or a Java HashMap.
-        final = {}
-        while True:
-            # Find the type of each tag in a compound in turn.
-            tag = read('b', 1)[0]
-            if tag == 0:
-                # A tag of 0 means we've reached NBTTagEnd, used to terminate
-                # a NBTTagCompound.
-                break
-            # We read in each tag in turn, using its name as the key in
-            # the dict (Since a compound cannot have repeating names,
-            # this works fine).
-            name = cls._read_utf8(read)
-            final[name] = _tags[tag].read(read)
-        return cls(final)
+        return _read_tree(read, cls)
 
     def pretty(self, rest_indent=0, indent_str='  '):
-        t = []
-        if len(self.value) > 0:
-            t.append('{{ {} entries'.format(len(self.value)))
+        out = StringIO()
+        self._pretty_into(out, rest_indent, indent_str)
+        return out.getvalue()
+
+    def _pretty_into(self, out, rest_indent, indent_str):
+        if len(self) > 0:
+            out.write('{{ {} entries'.format(len(self)))
+            prefix = '\n' + indent_str * (rest_indent + 1)
             for k, v in self.items():
-                it_pretty = v.pretty(rest_indent + 1, indent_str)
-                t.append('{}{}: {}'.format(indent_str * (rest_indent + 1), k, it_pretty))
-            t.append('{}}}'.format(indent_str * rest_indent))
+                out.write('{}{}: '.format(prefix, k))
+                v._pretty_into(out, rest_indent + 1, indent_str)
+            out.write('\n{}}}'.format(indent_str * rest_indent))
         else:
-            t.append('{}')
-        return '\n'.join(t)
+            out.write('{}')
 
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, len(self))
@@ -239,63 +320,83 @@ class NBTTagCompound(NBTBase, dict):
         super(NBTTagCompound, self).update(*args, **kwargs)
 
 class NBTTagList(NBTBase, list):
-    @classmethod
-    def type(cls): return NBTType.LIST
+    __slots__ = ('type',)
+    tag_type = NBTType.LIST
 
     def __init__(self, type, value=None):
         """
         Creates a new homogeneous list of `type` items, copying `value`
         if provided.
         """
-        self.value = self
         self.type = type
         if value is not None:
             self.extend(value)
 
+    @property
+    def value(self):
+        # The list is its own value
+        return self
+
     def write(self, write):
-        write('bi', self.type.type(), len(self.value))
-        for item in self.value:
+        item_type = self.type
+        write('bi', item_type.tag_type, len(self))
+        for item in self:
             # If our list item isn't of type self._type, convert
             # it before writing.
-            if not isinstance(item, self.type):
-                item = self.type(item)
+            if item.__class__ is not item_type and not isinstance(item, item_type):
+                item = item_type(item)
             item.write(write)
 
     @classmethod
     def read(cls, read):
         # A NBTTagList is a very simple homogeneous array, similar to
         # Python's native list() object, but restricted to a single type.
-        tag_type, length = read('bi', 5)
-        tag_read = _tags[tag_type].read
-        return cls(
-            _tags[tag_type],
-            [tag_read(read) for x in range(0, length)]
-        )
+        return _read_tree(read, cls)
 
     def pretty(self, rest_indent=0, indent_str='  '):
-        t = []
-        if len(self.value) > 0:
-            t.append('[ {} entries'.format(len(self.value)))
-            for v in self.value:
-                it_pretty = v.pretty(rest_indent + 1, indent_str)
-                t.append('{}{}'.format(indent_str * (rest_indent + 1), it_pretty))
-            t.append('{}]'.format(indent_str * rest_indent))
+        out = StringIO()
+        self._pretty_into(out, rest_indent, indent_str)
+        return out.getvalue()
+
+    def _pretty_into(self, out, rest_indent, indent_str):
+        if len(self) > 0:
+            out.write('[ {} entries'.format(len(self)))
+            prefix = '\n' + indent_str * (rest_indent + 1)
+            for v in self:
+                out.write(prefix)
+                v._pretty_into(out, rest_indent + 1, indent_str)
+            out.write('\n{}]'.format(indent_str * rest_indent))
         else:
-            t.append('[]')
-        return '\n'.join(t)
+            out.write('[]')
 
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, len(self))
 
 class NBTTagArray(NBTBase):
-    __slots__ = ('value')
-
-    @property
-    def fmt(self): return ''
+    __slots__ = ('value',)
+    typecode = ''
 
     def write(self, write):
-        l = len(self.value)
-        write(self.fmt.format(l), l, *self.value)
+        # The payload is written at once from a typed array, swapping bytes if needed
+        value = self.value
+        if not isinstance(value, array) or value.typecode != self.typecode:
+            value = array(self.typecode, value)
+        if write.little_endian != (sys.byteorder == 'little'):
+            if value is self.value:
+                value = array(self.typecode, value)
+            value.byteswap()
+        write('i', len(value))
+        write.io.write(value.tobytes())
+
+    @classmethod
+    def read(cls, read):
+        # The payload is read at once straight into an `array` of `typecode`
+        length = read.i4()
+        value = array(cls.typecode)
+        value.frombytes(read.bytes(length * value.itemsize))
+        if read.little_endian != (sys.byteorder == 'little'):
+            value.byteswap()
+        return cls(value)
 
     def pretty(self, rest_indent=0, indent_str='  '):
         if len(self.value) <= 11:
@@ -304,68 +405,49 @@ class NBTTagArray(NBTBase):
             return '{} [ {} elements ]'.format(self.__class__.__name__, len(self.value))
 
 class NBTTagByteArray(NBTTagArray):
-    @property
-    def fmt(self): return 'i{0}b'
-
-    @classmethod
-    def type(cls): return NBTType.BYTE_ARRAY
-
-    @classmethod
-    def read(cls, read):
-        length = read('i', 4)[0]
-        return cls(read('{0}b'.format(length), length))
+    __slots__ = ()
+    typecode = 'b'
+    tag_type = NBTType.BYTE_ARRAY
 
 class NBTTagIntArray(NBTTagArray):
-    @property
-    def fmt(self): return 'i{0}i'
-
-    @classmethod
-    def type(cls): return NBTType.INT_ARRAY
-
-    @classmethod
-    def read(cls, read):
-        length = read('i', 4)[0]
-        return cls(read('{0}i'.format(length), length * 4))
+    __slots__ = ()
+    typecode = 'i'
+    tag_type = NBTType.INT_ARRAY
 
 class NBTTagLongArray(NBTTagArray):
-    @property
-    def fmt(self): return 'i{0}q'
-
-    @classmethod
-    def type(cls): return NBTType.LONG_ARRAY
-
-    @classmethod
-    def read(cls, read):
-        length = read('i', 4)[0]
-        return cls(read('{0}q'.format(length), length * 8))
+    __slots__ = ()
+    typecode = 'q'
+    tag_type = NBTType.LONG_ARRAY
 
 class NBTTagShortArray(NBTTagArray):
-    @property
-    def fmt(self): return 'i{0}h'
-
-    @classmethod
-    def type(cls): return NBTType.SHORT_ARRAY
-
-    @classmethod
-    def read(cls, read):
-        length = read('i', 4)[0]
-        return cls(read('{0}h'.format(length), length * 2))
+    __slots__ = ()
+    typecode = 'h'
+    tag_type = NBTType.SHORT_ARRAY
 
 class NBTTagFloatArray(NBTTagArray):
-    @property
-    def fmt(self): return 'i{0}f'
+    __slots__ = ()
+    typecode = 'f'
+    tag_type = NBTType.FLOAT_ARRAY
 
     @classmethod
-    def type(cls): return NBTType.FLOAT_ARRAY
+    def from_bytes(cls, data):
+        """
+        Creates an array from a buffer of native 32-bit floats, any
+        C-contiguous object supporting the buffer protocol is accepted.
+        """
+        value = array('f')
+        value.frombytes(memoryview(data).cast('B'))
+        return cls(value)
 
-    @classmethod
-    def read(cls, read):
-        length = read('i', 4)[0]
-        return cls(read('{0}f'.format(length), length * 4))
+    def pretty(self, rest_indent=0, indent_str='  '):
+        if len(self.value) <= 11:
+            return '{} [{}]'.format(self.__class__.__name__, ', '.join(map(_float32_repr, self.value)))
+        else:
+            return super().pretty(rest_indent, indent_str)
 
 class NBTTagUShortArray(NBTTagShortArray):
-    @property
-    def fmt(self): return 'i{0}H'
+    __slots__ = ()
+    typecode = 'H'
 
 # The NBTTag* types have the convienient property of being continuous.
 # The code is written in such a way that if this were to no longer be
@@ -388,6 +470,65 @@ _tags = (
     NBTTagFloatArray   # 0x0E
 )
 
+def _open_tag(read, cls, name):
+    """
+    Starts the payload of a compound or list tag `cls` that is stored under
+    `name` in its parent. The returned [cls, name, values, item type, items
+    left] entry lives on the _read_tree stack until the payload is complete.
+    """
+    if cls.tag_type == NBTType.COMPOUND:
+        return [cls, name, {}, None, 0]
+    item_type = read.i1()
+    length = read.i4()
+    if item_type == NBTType.COMPOUND or item_type == NBTType.LIST:
+        return [cls, name, [], item_type, length]
+    # Leaf items can't open containers, read them all at once
+    tag_read = _tags[item_type].read
+    return [cls, name, [tag_read(read) for x in range(length)], item_type, 0]
+
+def _read_tree(read, cls):
+    """
+    Reads the payload of a compound or list tag `cls`, keeping nested
+    containers on an explicit stack instead of recursing into them.
+    """
+    read_i1 = read.i1
+    read_utf8 = NBTBase._read_utf8
+    stack = []
+    top = _open_tag(read, cls, None)
+    while True:
+        if top[3] is None:
+            tag = read_i1()
+            # A tag of 0 means we've reached NBTTagEnd, used to terminate
+            # a NBTTagCompound.
+            if tag != 0:
+                # We read in each tag in turn, using its name as the key in
+                # the dict (Since a compound cannot have repeating names,
+                # this works fine).
+                name = read_utf8(read)
+                if tag == NBTType.COMPOUND or tag == NBTType.LIST:
+                    stack.append(top)
+                    top = _open_tag(read, _tags[tag], name)
+                else:
+                    top[2][name] = _tags[tag].read(read)
+                continue
+        elif top[4] > 0:
+            top[4] -= 1
+            stack.append(top)
+            top = _open_tag(read, _tags[top[3]], None)
+            continue
+
+        if top[3] is None:
+            value = top[0](top[2])
+        else:
+            value = top[0](_tags[top[3]], top[2])
+        if not stack:
+            return value
+        name = top[1]
+        top = stack.pop()
+        if name is None:
+            top[2].append(value)
+        else:
+            top[2][name] = value
 
 class NBTFile(NBTTagCompound):
     def __init__(self, io=None, value=None, little_endian=False):
@@ -406,15 +547,13 @@ class NBTFile(NBTTagCompound):
 
         # The pocket edition uses little-endian NBT files, but annoyingly
         # without any kind of header we can't determine that ourselves,
-        # not even a magic number we could flip.
-        if little_endian:
-            read = lambda fmt, size: unpack('<' + fmt, io.read(size))
-        else:
-            read = lambda fmt, size: unpack('>' + fmt, io.read(size))
-        read.io = io
+        # not even a magic number we could flip. The whole file is read at
+        # once, tags are then unpacked straight from the buffer.
+        reader = _LEReader if little_endian else _BEReader
+        read = reader(memoryview(io.read()))
 
         # All valid NBT files will begin with 0x0A, which is a NBTTagCompound.
-        if read('b', 1)[0] != 0x0A:
+        if read.i1() != 0x0A:
             raise IOError('NBTFile does not begin with 0x0A.')
         NBTTagCompound._read_utf8(read)
 
@@ -426,11 +565,10 @@ class NBTFile(NBTTagCompound):
         Saves the `NBTFile()` to `io`, which can be any file-like object
         providing `write()`.
         """
-        if little_endian:
-            write = lambda fmt, *args: io.write(pack('<' + fmt, *args))
-        else:
-            write = lambda fmt, *args: io.write(pack('>' + fmt, *args))
+        struct = _struct_le if little_endian else _struct_be
+        write = lambda fmt, *args: io.write(struct(fmt).pack(*args))
         write.io = io
+        write.little_endian = little_endian
 
         self.write(write)
 
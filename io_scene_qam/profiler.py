@@ -1,37 +1,38 @@
+import os
 import time
 
 __all__ = (
     'profile', 'profile_print', 'print_profiler'
 )
 
+# Total nanoseconds and number of calls by profiled name
 prof = {}
-prof_level = 1
+# Functions with a higher level are left undecorated. QAM_PROFILE overrides the level
+# at import time, e.g. 3 to profile the per-vertex methods or -1 to profile nothing.
+try:
+    prof_level = int(os.environ.get('QAM_PROFILE', 1))
+except ValueError:
+    prof_level = 1
 
-class profile:
+def profile(name, level=0):
     '''Function decorator for code profiling.'''
 
-    def __init__(self, name, level=0):
-        self.name = name
-        self.level = level
+    if level > prof_level:
+        return lambda fun: fun
 
-    def __call__(self, fun):
+    perf_counter_ns = time.perf_counter_ns
+
+    def decorator(fun):
         def profile_fun(*args, **kwargs):
-            start = time.process_time()
+            start = perf_counter_ns()
             try:
                 return fun(*args, **kwargs)
             finally:
-                duration = time.process_time() - start
-                if self.name not in prof:
-                    prof[self.name] = [self.name, duration, 1]
-                else:
-                    it = prof[self.name]
-                    it[1] += duration
-                    it[2] += 1
-
-        if self.level <= prof_level:
-            return profile_fun
-        else:
-            return fun
+                stats = prof.setdefault(name, [0, 0])
+                stats[0] += perf_counter_ns() - start
+                stats[1] += 1
+        return profile_fun
+    return decorator
 
 class profile_print:
     def __call__(self, fun):
@@ -45,17 +46,19 @@ class profile_print:
 def print_profiler():
     '''Prints profiling results to the console. Run from a Python controller.'''
 
-    def timekey(stat):
-        return stat[1] / float(stat[2])
-    stats = sorted(prof.values(), key=timekey, reverse=True)
+    def timekey(item):
+        return item[1][0] / item[1][1]
+    if not prof:
+        return
+    stats = sorted(prof.items(), key=timekey, reverse=True)
 
     print('=== Execution Statistics ===')
     print('Times are in milliseconds.')
     print('{:<55} {:>6} {:>7} {:>6}'.format('FUNCTION', 'CALLS', 'SUM(ms)', 'AV(ms)'))
-    for stat in stats:
+    for name, (total, calls) in stats:
         print('{:<55} {:>6} {:>7.0f} {:>6.2f}'.format(
-            stat[0], stat[2],
-            stat[1] * 1000,
-            (stat[1] / float(stat[2])) * 1000))
+            name, calls,
+            total / 1e6,
+            total / calls / 1e6))
     print('============================')
     prof.clear()
@@ -1,4 +1,5 @@
-from math import fabs, isclose
+from bisect import bisect_left
+from math import fabs, isclose, sqrt
 import struct
 
 # Global rounding factor for floats
@@ -17,19 +18,16 @@ def limitFloatPrecision(floatNumber):
     return float(round(floatNumber, FROUND))
 
 def limitFloatListPrecision(listOfFloats):
-    for i in range(0, len(listOfFloats)):
-        listOfFloats[i] = float(round(listOfFloats[i], FROUND))
+    listOfFloats[:] = [float(round(x, FROUND)) for x in listOfFloats]
     return listOfFloats
 
-def hashList(list):
-    out = 0
-    if list is not None:
-        for i in range(0, len(list)):
-            out = 31 * out + hash(list[i])
-    return out
+# Rest values of the transform components, rotations are quaternions in x, y, z, w order
+DEFAULT_TRANSLATION = (0.0, 0.0, 0.0)
+DEFAULT_ROTATION = (0.0, 0.0, 0.0, 1.0)
+DEFAULT_SCALE = (1.0, 1.0, 1.0)
 
 def eq(v1, v2):
-    return abs(v1 - v2) <= 0.000001
+    return abs(v1 - v2) <= FROUND_VALUE
 
 def is0(v):
     return eq(v, 0.0)
@@ -37,81 +35,82 @@ def is0(v):
 def is1(v):
     return eq(v, 1.0)
 
-def testDefaultQuaternion(vec):
-    return vec is None \
-        or (is1(vec[0]) and is0(vec[1]) and is0(vec[2]) and is0(vec[3]))
-
-def testDefaultScale(vec):
-    return vec is None \
-        or (is1(vec[0]) and is1(vec[1]) and is1(vec[2]))
-
-def testDefaultTransform(vec):
-    return vec is None \
-        or (is0(vec[0]) and is0(vec[1]) and is0(vec[2]))
+def fastNormalizeQuaternion(q):
+    """Normalizes a quaternion with one Newton step if it is almost unit-length"""
+    s = q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3]
+    if fabs(s - 1.0) > 0.001:
+        if s == 0.0:
+            return q[0], q[1], q[2], q[3]
+        k = 1.0 / sqrt(s)
+    else:
+        k = 0.5 * (3.0 - s)
+    return q[0] * k, q[1] * k, q[2] * k, q[3] * k
+
+# Four bytes packed into one big-endian float
+COLOR_STRUCT = struct.Struct('>4B')
+FLOAT_STRUCT = struct.Struct('>f')
+BITS_STRUCT = struct.Struct('>I')
 
 def bitsToFloat(b):
-    s = struct.pack('>I', b)
-    return struct.unpack('>f', s)[0]
+    return FLOAT_STRUCT.unpack(BITS_STRUCT.pack(b))[0]
 
 def floatToBits(f):
-    s = struct.pack('>f', f)
-    return struct.unpack('>I', s)[0]
+    return BITS_STRUCT.unpack(FLOAT_STRUCT.pack(f))[0]
 
 def wrapFloat4(v1, v2, v3, v4):
-    b = ((int(v1 * 255.0) & 255) << 24) | \
-        ((int(v2 * 255.0) & 255) << 16) | \
-        ((int(v3 * 255.0) & 255) << 8) | \
-        ((int(v4 * 255.0) & 255) << 0)
-    return bitsToFloat(b)
+    b = COLOR_STRUCT.pack(
+        int(v1 * 255.0) & 255,
+        int(v2 * 255.0) & 255,
+        int(v3 * 255.0) & 255,
+        int(v4 * 255.0) & 255)
+    return FLOAT_STRUCT.unpack(b)[0]
 
 def unwrapFloat4(v):
-    b = floatToBits(v)
-    return ((b >> 24) & 255) / 255.0, \
-           ((b >> 16) & 255) / 255.0, \
-           ((b >> 8) & 255) / 255.0, \
-           ((b >> 0) & 255) / 255.0
+    b = COLOR_STRUCT.unpack(FLOAT_STRUCT.pack(v))
+    return b[0] / 255.0, b[1] / 255.0, b[2] / 255.0, b[3] / 255.0
 
 # ## DEBUG METHODS ###
+# The level is fixed at import, so callers can gate costly messages themselves
+DEBUG_ON = LOG_LEVEL >= _DEBUG_
+INFO_ON = LOG_LEVEL >= _INFO_
+WARN_ON = LOG_LEVEL >= _WARN_
+ERROR_ON = LOG_LEVEL >= _ERROR_
+
 def debug(message, *args):
-    if LOG_LEVEL >= _DEBUG_:
-        finalMessage = message.format(*args)
-        print("[DEBUG] {!s}".format(finalMessage))
+    finalMessage = message.format(*args)
+    print("[DEBUG] {!s}".format(finalMessage))
 
 def info(message, *args):
-    if LOG_LEVEL >= _INFO_:
-        finalMessage = message.format(*args)
-        print("[INFO] {!s}".format(finalMessage))
+    finalMessage = message.format(*args)
+    print("[INFO] {!s}".format(finalMessage))
 
 def warn(message, *args):
-    if LOG_LEVEL >= _WARN_:
-        finalMessage = message.format(*args)
-        print("[WARN] {!s}".format(finalMessage))
+    finalMessage = message.format(*args)
+    print("[WARN] {!s}".format(finalMessage))
 
 def error(message, *args):
-    if LOG_LEVEL >= _ERROR_:
-        finalMessage = message.format(*args)
-        print("[ERROR] {!s}".format(finalMessage))
+    finalMessage = message.format(*args)
+    print("[ERROR] {!s}".format(finalMessage))
 
 def infoCaps(message, *args):
-    if LOG_LEVEL >= _INFO_:
-        finalMessage = message.format(*args).upper()
-        print("")
-        print("[INFO] {!s}".format(finalMessage))
+    finalMessage = message.format(*args).upper()
+    print("")
+    print("[INFO] {!s}".format(finalMessage))
+
+def _skipLog(message, *args):
+    pass
+
+# Log functions below LOG_LEVEL are replaced with a no-op
+if not DEBUG_ON:
+    debug = _skipLog
+if not INFO_ON:
+    info = infoCaps = _skipLog
+if not WARN_ON:
+    warn = _skipLog
+if not ERROR_ON:
+    error = _skipLog
 
 def binaryInsert(list, item):
-    low = 0
-    high = len(list) - 1
-    while low <= high:
-        mid = (low + high) // 2
-        midValue = list[mid]
-        cmp = midValue - item
-
-        if cmp < 0:
-            low = mid + 1
-        elif cmp > 0:
-            high = mid - 1
-        else:
-            low = mid
-            break
+    low = bisect_left(list, item)
     list.insert(low, item)
     return low
@@ -7,7 +7,7 @@ from matplotlib.widgets import Button, TextBox
 
 from approximator import Approximator
 
-from numpy import array
+from numpy import ascontiguousarray, asarray
 
 root = tk.Tk()
 root.withdraw()
@@ -52,10 +52,10 @@ class IterableApproxArray:
     def __init__(self, lists):
         if isinstance(lists, Transform):
             group = lists.lists + [lists.timings]
-            self.srcArray = array(list(zip(*group)))
+            self.srcArray = ascontiguousarray(asarray(group, dtype=float).T)
             self.dimSize = len(group)
         else:
-            self.srcArray = array(list(zip(*lists)))
+            self.srcArray = ascontiguousarray(asarray(lists, dtype=float).T)
             self.dimSize = len(lists)
         self.indices = None
         self.weights = None
@@ -65,17 +65,20 @@ class IterableApproxArray:
 
     def approximate(self):
         self.indices, self.weights = self.approximator.approximateIterable(self.srcArray, self.indices, self.weights)
-        for i in range(0, self.dimSize):
-            self.approx[i] = [self.srcArray[j][i] for j in self.indices]
+        self.pick(self.indices)
         item = self.approximator.findMaxError(self.weights)
         self.maxError = self.weights[item][1]
 
     def approximateByError(self, err):
         indices = self.approximator.approximate(self.srcArray, err)
-        for i in range(0, self.dimSize):
-            self.approx[i] = [self.srcArray[j][i] for j in indices]
+        self.pick(indices)
         self.maxError = None
 
+    def pick(self, indices):
+        # Gathers the picked rows at once, then splits them into per-dimension columns
+        picked = self.srcArray[indices]
+        self.approx = [picked[:, i] for i in range(0, self.dimSize)]
+
     def clean(self):
         self.indices = None
         self.weights = None